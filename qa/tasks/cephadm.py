@@ -2,13 +2,19 @@
 Ceph cluster task, deployed via cephadm orchestrator
 """
 import argparse
+import collections
 import configobj
 import contextlib
 import functools
+import gevent
 import json
 import logging
 import os
 import re
+import requests
+import shlex
+import tarfile
+import time
 import uuid
 import yaml
 
@@ -23,6 +29,7 @@ from teuthology import contextutil
 from teuthology import packaging
 from teuthology.orchestra import run
 from teuthology.orchestra.daemon import DaemonGroup
+from teuthology.parallel import parallel
 from teuthology.config import config as teuth_config
 from textwrap import dedent
 from tasks.cephfs.filesystem import MDSCluster, Filesystem
@@ -92,16 +99,36 @@ def _vip_vars(rctx):
             rctx[f'VIP{idx}'] = str(vip)
 
 
+def _roles_of_type(ctx, cluster_name, type_):
+    """
+    Return the (remote, role) pairs for the roles of type `type_` in
+    cluster `cluster_name`, in host order.
+
+    All roles are split and classified by type in one pass on first use
+    (i.e. after any mons for a roleless cluster have been fabricated), and
+    the result is kept in ctx.ceph[cluster_name].roles_by_type.
+    """
+    roles_by_type = getattr(ctx.ceph[cluster_name], 'roles_by_type', None)
+    if roles_by_type is None:
+        roles_by_type = collections.defaultdict(list)
+        for remote, role_list in ctx.cluster.remotes.items():
+            for role in role_list:
+                c_, t_, _ = teuthology.split_role(role)
+                if c_ == cluster_name:
+                    roles_by_type[t_].append((remote, role))
+        ctx.ceph[cluster_name].roles_by_type = roles_by_type
+    return roles_by_type.get(type_, [])
+
+
 def _shell(ctx, cluster_name, remote, args, extra_cephadm_args=[], **kwargs):
-    teuthology.get_testdir(ctx)
     return remote.run(
         args=[
             'sudo',
             ctx.cephadm,
             '--image', ctx.ceph[cluster_name].image,
             'shell',
-            '-c', '/etc/ceph/{}.conf'.format(cluster_name),
-            '-k', '/etc/ceph/{}.client.admin.keyring'.format(cluster_name),
+            '-c', ctx.ceph[cluster_name].paths.conf,
+            '-k', ctx.ceph[cluster_name].paths.admin_keyring,
             '--fsid', ctx.ceph[cluster_name].fsid,
             ] + extra_cephadm_args + [
             '--',
@@ -110,6 +137,50 @@ def _shell(ctx, cluster_name, remote, args, extra_cephadm_args=[], **kwargs):
     )
 
 
+def _write_files(remote, files, mode=0o644):
+    """Write several files on `remote` with a single remote command.
+
+    `files` maps absolute paths to their contents.  The files are packed
+    into a tarball which is extracted on the remote host.
+    """
+    buf = BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        for path, data in files.items():
+            if isinstance(data, str):
+                data = data.encode()
+            info = tarfile.TarInfo(os.path.relpath(path, '/'))
+            info.size = len(data)
+            info.mode = mode
+            info.mtime = int(time.time())
+            tar.addfile(info, BytesIO(data))
+    remote.run(
+        args=['tar', '-C', '/', '--no-same-owner', '-xf', '-'],
+        stdin=buf.getvalue(),
+    )
+
+
+def _read_files(remote, paths):
+    """Read several files from `remote` with a single remote command.
+
+    The files are read (as root) into a tarball which is unpacked in
+    memory.  Returns a dict mapping each of `paths` to its contents.
+    """
+    # tar member names are the normalized relative paths; map them back
+    # to the paths we were given
+    names = {os.path.relpath(path, '/'): path for path in paths}
+    r = remote.run(
+        args=['sudo', 'tar', '-C', '/', '-cf', '-'] + list(names),
+        stdout=BytesIO(),
+    )
+    r.stdout.seek(0)
+    files = {}
+    with tarfile.open(fileobj=r.stdout, mode='r|') as tar:
+        for member in tar:
+            if member.isfile():
+                files[names[member.name]] = tar.extractfile(member).read()
+    return files
+
+
 def build_initial_config(ctx, config):
     cluster_name = config['cluster']
 
@@ -217,18 +288,22 @@ def _fetch_cephadm_from_rpm(ctx):
     )
 
 
-def _fetch_cephadm_from_github(ctx, config, ref):
-    ref = config.get('cephadm_branch', ref)
-    git_url = config.get('cephadm_git_url', teuth_config.get_ceph_git_url())
-    log.info('Downloading cephadm (repo %s ref %s)...' % (git_url, ref))
-    if git_url.startswith('https://github.com/'):
-        # git archive doesn't like https:// URLs, which we use with github.
-        rest = git_url.split('https://github.com/', 1)[1]
-        rest = re.sub(r'\.git/?$', '', rest).strip() # no .git suffix
+def _download_cephadm(ctx, url):
+    """
+    Fetch cephadm from `url` once, on the teuthology host, and push it to
+    all remotes in parallel.  Fall back to fetching it with curl on each
+    remote if the local download fails.
+    """
+    try:
+        # fail over quickly if we cannot connect at all
+        resp = requests.get(url, timeout=(10, 300))
+        resp.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        log.warning('Failed to download %s locally (%s), '
+                    'downloading it on each host instead', url, e)
         ctx.cluster.run(
             args=[
-                'curl', '--silent',
-                'https://raw.githubusercontent.com/' + rest + '/' + ref + '/src/cephadm/cephadm',
+                'curl', '--silent', '-L', url,
                 run.Raw('>'),
                 ctx.cephadm,
                 run.Raw('&&'),
@@ -236,6 +311,26 @@ def _fetch_cephadm_from_github(ctx, config, ref):
                 ctx.cephadm,
             ],
         )
+        return
+    log.info('Downloaded cephadm (%d bytes), copying it to all hosts...',
+             len(resp.content))
+    with parallel() as p:
+        for remote in ctx.cluster.remotes.keys():
+            p.spawn(remote.write_file, ctx.cephadm, resp.content)
+
+
+def _fetch_cephadm_from_github(ctx, config, ref):
+    ref = config.get('cephadm_branch', ref)
+    git_url = config.get('cephadm_git_url', teuth_config.get_ceph_git_url())
+    log.info('Downloading cephadm (repo %s ref %s)...' % (git_url, ref))
+    if git_url.startswith('https://github.com/'):
+        # git archive doesn't like https:// URLs, which we use with github.
+        rest = git_url.split('https://github.com/', 1)[1]
+        rest = re.sub(r'\.git/?$', '', rest).strip() # no .git suffix
+        _download_cephadm(
+            ctx,
+            'https://raw.githubusercontent.com/' + rest + '/' + ref + '/src/cephadm/cephadm',
+        )
     else:
         ctx.cluster.run(
             args=[
@@ -290,16 +385,7 @@ def _fetch_cephadm_from_chachra(ctx, config, cluster_name):
             sha1=sha1,
     )
     log.info("Discovered cachra url: %s", url)
-    ctx.cluster.run(
-        args=[
-            'curl', '--silent', '-L', url,
-            run.Raw('>'),
-            ctx.cephadm,
-            run.Raw('&&'),
-            'ls', '-l',
-            ctx.cephadm,
-        ],
-    )
+    _download_cephadm(ctx, url)
 
     # sanity-check the resulting file and set executable bit
     cephadm_file_size = '$(stat -c%s {})'.format(ctx.cephadm)
@@ -339,16 +425,7 @@ def _fetch_stable_branch_cephadm_from_chacra(ctx, config, cluster_name):
             branch=branch,
     )
     log.info("Discovered cachra url: %s", url)
-    ctx.cluster.run(
-        args=[
-            'curl', '--silent', '-L', url,
-            run.Raw('>'),
-            ctx.cephadm,
-            run.Raw('&&'),
-            'ls', '-l',
-            ctx.cephadm,
-        ],
-    )
+    _download_cephadm(ctx, url)
 
     # sanity-check the resulting file and set executable bit
     cephadm_file_size = '$(stat -c%s {})'.format(ctx.cephadm)
@@ -385,6 +462,30 @@ def _rm_cephadm(ctx):
     )
 
 
+def _archive_remote_dirs(ctx, remote_dir, name):
+    """
+    Pull `remote_dir` from every remote into <archive>/remote/<host>/<name>.
+
+    Each remote sends the directory as a single tar stream, and all remotes
+    are pulled at the same time.
+    """
+    path = os.path.join(ctx.archive, 'remote')
+    os.makedirs(path, exist_ok=True)
+
+    def _pull(remote):
+        sub = os.path.join(path, remote.shortname)
+        os.makedirs(sub, exist_ok=True)
+        try:
+            teuthology.pull_directory(remote, remote_dir,
+                                      os.path.join(sub, name))
+        except ReadError:
+            pass
+
+    with parallel() as p:
+        for remote in ctx.cluster.remotes.keys():
+            p.spawn(_pull, remote)
+
+
 @contextlib.contextmanager
 def ceph_log(ctx, config):
     cluster_name = config['cluster']
@@ -482,22 +583,8 @@ def ceph_log(ctx, config):
             )
 
             log.info('Archiving logs...')
-            path = os.path.join(ctx.archive, 'remote')
-            try:
-                os.makedirs(path)
-            except OSError:
-                pass
-            for remote in ctx.cluster.remotes.keys():
-                sub = os.path.join(path, remote.shortname)
-                try:
-                    os.makedirs(sub)
-                except OSError:
-                    pass
-                try:
-                    teuthology.pull_directory(remote, '/var/log/ceph',  # everything
-                                              os.path.join(sub, 'log'))
-                except ReadError:
-                    pass
+            _archive_remote_dirs(ctx, '/var/log/ceph',  # everything
+                                 'log')
 
 
 @contextlib.contextmanager
@@ -516,23 +603,7 @@ def ceph_crash(ctx, config):
     finally:
         if ctx.archive is not None:
             log.info('Archiving crash dumps...')
-            path = os.path.join(ctx.archive, 'remote')
-            try:
-                os.makedirs(path)
-            except OSError:
-                pass
-            for remote in ctx.cluster.remotes.keys():
-                sub = os.path.join(path, remote.shortname)
-                try:
-                    os.makedirs(sub)
-                except OSError:
-                    pass
-                try:
-                    teuthology.pull_directory(remote,
-                                              '/var/lib/ceph/%s/crash' % fsid,
-                                              os.path.join(sub, 'crash'))
-                except ReadError:
-                    pass
+            _archive_remote_dirs(ctx, '/var/lib/ceph/%s/crash' % fsid, 'crash')
 
 
 @contextlib.contextmanager
@@ -572,22 +643,24 @@ def setup_ca_signed_keys(ctx, config):
     ], stdout=StringIO())
     ca_key_pub_contents = r.stdout.getvalue()
 
-    # make CA key accepted on each host
-    for remote in ctx.cluster.remotes.keys():
-        # write key to each host's /etc/ssh dir
-        remote.run(args=[
-            'sudo', 'echo', ca_key_pub_contents,
-            run.Raw('|'),
-            'sudo', 'tee', '-a', '/etc/ssh/ca-key.pub',
-        ])
-        # make sshd accept the CA signed key
-        remote.run(args=[
-            'sudo', 'echo', 'TrustedUserCAKeys /etc/ssh/ca-key.pub',
-            run.Raw('|'),
-            'sudo', 'tee', '-a', '/etc/ssh/sshd_config',
-            run.Raw('&&'),
-            'sudo', 'systemctl', 'restart', 'sshd',
-        ])
+    # make CA key accepted on each host: write key to each host's /etc/ssh
+    # dir and make sshd accept the CA signed key, all in one go
+    run.wait(
+        ctx.cluster.run(
+            args=[
+                'sudo', 'echo', ca_key_pub_contents,
+                run.Raw('|'),
+                'sudo', 'tee', '-a', '/etc/ssh/ca-key.pub',
+                run.Raw('&&'),
+                'sudo', 'echo', 'TrustedUserCAKeys /etc/ssh/ca-key.pub',
+                run.Raw('|'),
+                'sudo', 'tee', '-a', '/etc/ssh/sshd_config',
+                run.Raw('&&'),
+                'sudo', 'systemctl', 'restart', 'sshd',
+            ],
+            wait=False,
+        )
+    )
 
     # generate a new key pair and sign the pub key to make a cert
     bootstrap_remote.run(args=[
@@ -630,29 +703,25 @@ def ceph_bootstrap(ctx, config):
     :param config: the config dict
     """
     cluster_name = config['cluster']
-    testdir = teuthology.get_testdir(ctx)
     fsid = ctx.ceph[cluster_name].fsid
 
     bootstrap_remote = ctx.ceph[cluster_name].bootstrap_remote
     first_mon = ctx.ceph[cluster_name].first_mon
     first_mon_role = ctx.ceph[cluster_name].first_mon_role
     mons = ctx.ceph[cluster_name].mons
+    paths = ctx.ceph[cluster_name].paths
 
     ctx.cluster.run(args=[
         'sudo', 'mkdir', '-p', '/etc/ceph',
-        ]);
-    ctx.cluster.run(args=[
+        run.Raw('&&'),
         'sudo', 'chmod', '777', '/etc/ceph',
-        ]);
+        ])
     try:
-        # write seed config
-        log.info('Writing seed config...')
+        # build seed config; it is written out by the bootstrap command
+        log.info('Building seed config...')
         conf_fp = BytesIO()
         seed_config = build_initial_config(ctx, config)
         seed_config.write(conf_fp)
-        bootstrap_remote.write_file(
-            path='{}/seed.{}.conf'.format(testdir, cluster_name),
-            data=conf_fp.getvalue())
         log.debug('Final config:\n' + conf_fp.getvalue().decode())
         ctx.ceph[cluster_name].conf = seed_config
 
@@ -685,14 +754,13 @@ def ceph_bootstrap(ctx, config):
             '-v',
             'bootstrap',
             '--fsid', fsid,
-            '--config', '{}/seed.{}.conf'.format(testdir, cluster_name),
-            '--output-config', '/etc/ceph/{}.conf'.format(cluster_name),
-            '--output-keyring',
-            '/etc/ceph/{}.client.admin.keyring'.format(cluster_name),
+            '--config', paths.seed_conf,
+            '--output-config', paths.conf,
+            '--output-keyring', paths.admin_keyring,
         ]
 
         if not config.get("use-ca-signed-key", False):
-            cmd += ['--output-pub-ssh-key', '{}/{}.pub'.format(testdir, cluster_name)]
+            cmd += ['--output-pub-ssh-key', paths.pub_ssh_key]
         else:
             # ctx.ca_signed_key_info should have been set up in
             # setup_ca_signed_keys function which we expect to have
@@ -737,27 +805,29 @@ def ceph_bootstrap(ctx, config):
         # bootstrap makes the keyring root 0600, so +r it for our purposes
         cmd += [
             run.Raw('&&'),
-            'sudo', 'chmod', '+r',
-            '/etc/ceph/{}.client.admin.keyring'.format(cluster_name),
+            'sudo', 'chmod', '+r', paths.admin_keyring,
         ]
-        bootstrap_remote.run(args=cmd)
+        # write the seed config from stdin in the same command, rather
+        # than paying for a separate round trip
+        bootstrap_remote.run(
+            args=['cat', run.Raw('>'), paths.seed_conf, run.Raw('&&')] + cmd,
+            stdin=conf_fp.getvalue(),
+        )
 
         # fetch keys and configs
-        log.info('Fetching config...')
-        ctx.ceph[cluster_name].config_file = \
-            bootstrap_remote.read_file(f'/etc/ceph/{cluster_name}.conf')
-        log.info('Fetching client.admin keyring...')
-        ctx.ceph[cluster_name].admin_keyring = \
-            bootstrap_remote.read_file(f'/etc/ceph/{cluster_name}.client.admin.keyring')
-        log.info('Fetching mon keyring...')
-        ctx.ceph[cluster_name].mon_keyring = \
-            bootstrap_remote.read_file(f'/var/lib/ceph/{fsid}/mon.{first_mon}/keyring', sudo=True)
+        log.info('Fetching config, client.admin keyring and mon keyring...')
+        mon_keyring_path = f'/var/lib/ceph/{fsid}/mon.{first_mon}/keyring'
+        to_fetch = [paths.conf, paths.admin_keyring, mon_keyring_path]
+        if not config.get("use-ca-signed-key", False):
+            to_fetch.append(paths.pub_ssh_key)
+        files = _read_files(bootstrap_remote, to_fetch)
+        ctx.ceph[cluster_name].config_file = files[paths.conf]
+        ctx.ceph[cluster_name].admin_keyring = files[paths.admin_keyring]
+        ctx.ceph[cluster_name].mon_keyring = files[mon_keyring_path]
 
         if not config.get("use-ca-signed-key", False):
-            # fetch ssh key, distribute to additional nodes
-            log.info('Fetching pub ssh key...')
-            ssh_pub_key = bootstrap_remote.read_file(
-                f'{testdir}/{cluster_name}.pub').decode('ascii').strip()
+            # distribute ssh key to additional nodes
+            ssh_pub_key = files[paths.pub_ssh_key].decode('ascii').strip()
 
             log.info('Installing pub ssh key for root users...')
             ctx.cluster.run(args=[
@@ -770,43 +840,53 @@ def ceph_bootstrap(ctx, config):
                 'sudo', 'chmod', '0600', '/root/.ssh/authorized_keys',
             ])
 
-        # set options
+        # set options, within a single shell; bash -x logs each command
+        # as it runs
+        script = ''
         if config.get('allow_ptrace', True):
-            _shell(ctx, cluster_name, bootstrap_remote,
-                   ['ceph', 'config', 'set', 'mgr', 'mgr/cephadm/allow_ptrace', 'true'])
+            script += 'ceph config set mgr mgr/cephadm/allow_ptrace true\n'
 
         if not config.get('avoid_pacific_features', False):
-            log.info('Distributing conf and client.admin keyring to all hosts + 0755')
+            # distribute conf and client.admin keyring to all hosts + 0755;
+            # failure here is not fatal
+            script += ("ceph orch client-keyring set client.admin '*' "
+                       "--mode 0755 || true\n")
+
+        if script:
+            log.info('Setting options...')
             _shell(ctx, cluster_name, bootstrap_remote,
-                   ['ceph', 'orch', 'client-keyring', 'set', 'client.admin',
-                    '*', '--mode', '0755'],
-                   check_status=False)
+                   ['bash', '-xec', script])
 
         # add other hosts
-        for remote in ctx.cluster.remotes.keys():
-            if remote == bootstrap_remote:
-                continue
-
-            # note: this may be redundant (see above), but it avoids
-            # us having to wait for cephadm to do it.
-            log.info('Writing (initial) conf and keyring to %s' % remote.shortname)
-            remote.write_file(
-                path='/etc/ceph/{}.conf'.format(cluster_name),
-                data=ctx.ceph[cluster_name].config_file)
-            remote.write_file(
-                path='/etc/ceph/{}.client.admin.keyring'.format(cluster_name),
-                data=ctx.ceph[cluster_name].admin_keyring)
-
-            log.info('Adding host %s to orchestrator...' % remote.shortname)
-            _shell(ctx, cluster_name, bootstrap_remote, [
-                'ceph', 'orch', 'host', 'add',
-                remote.shortname
-            ])
+        other_remotes = [remote for remote in ctx.cluster.remotes.keys()
+                         if remote != bootstrap_remote]
+
+        # note: this may be redundant (see above), but it avoids
+        # us having to wait for cephadm to do it.
+        with parallel() as p:
+            for remote in other_remotes:
+                log.info('Writing (initial) conf and keyring to %s' % remote.shortname)
+                p.spawn(_write_files, remote, {
+                    paths.conf: ctx.ceph[cluster_name].config_file,
+                    paths.admin_keyring: ctx.ceph[cluster_name].admin_keyring,
+                })
+
+        if other_remotes:
+            # add all hosts, one at a time, and then list them, within a
+            # single shell so we only pay for one container start; bash -x
+            # logs each command as it runs
+            script = ''
+            for remote in other_remotes:
+                script += 'ceph orch host add {} >&2\n'.format(
+                    shlex.quote(remote.shortname))
+            script += 'ceph orch host ls --format=json\n'
+            log.info('Adding %d hosts to orchestrator...' % len(other_remotes))
             r = _shell(ctx, cluster_name, bootstrap_remote,
-                       ['ceph', 'orch', 'host', 'ls', '--format=json'],
+                       ['bash', '-xec', script],
                        stdout=StringIO())
             hosts = [node['hostname'] for node in json.loads(r.stdout.getvalue())]
-            assert remote.shortname in hosts
+            for remote in other_remotes:
+                assert remote.shortname in hosts
 
         yield
 
@@ -814,8 +894,8 @@ def ceph_bootstrap(ctx, config):
         log.info('Cleaning up testdir ceph.* files...')
         ctx.cluster.run(args=[
             'rm', '-f',
-            '{}/seed.{}.conf'.format(testdir, cluster_name),
-            '{}/{}.pub'.format(testdir, cluster_name),
+            paths.seed_conf,
+            paths.pub_ssh_key,
         ])
 
         log.info('Stopping all daemons...')
@@ -847,12 +927,47 @@ def ceph_bootstrap(ctx, config):
 
         # clean up /etc/ceph
         ctx.cluster.run(args=[
-            'sudo', 'rm', '-f',
-            '/etc/ceph/{}.conf'.format(cluster_name),
-            '/etc/ceph/{}.client.admin.keyring'.format(cluster_name),
+            'sudo', 'rm', '-f', paths.conf, paths.admin_keyring,
         ])
 
 
+def _wait_for_mons(ctx, cluster_name, remote, num_mons, timeout=900,
+                   first=None):
+    """
+    Wait for the monmap to contain `num_mons` mons.
+
+    The polling loop runs on the remote host, inside a single cephadm shell,
+    backing off exponentially (up to 8 seconds) between polls.  This saves
+    an ssh round trip and a container start per poll.  `timeout` is the
+    maximum time to wait, in seconds, before failing.
+
+    If given, the command `first` (an argument list) is run in the same
+    shell before polling starts; if it fails, we do not wait.
+    """
+    script = ''
+    if first:
+        script += shlex.join(first) + ' || exit 1\n'
+    log.info('Waiting for %d mons in monmap...' % num_mons)
+    _shell(ctx, cluster_name, remote, [
+        'bash', '-c', script + dedent(f"""\
+            delay=1
+            deadline=$((SECONDS + {timeout}))
+            while true; do
+                n=$(ceph mon stat -f json | python3 -c \\
+                    'import json, sys; print(json.load(sys.stdin)["num_mons"])')
+                echo "have $n/{num_mons} mons" >&2
+                [ "$n" = {num_mons} ] && exit 0
+                if [ $SECONDS -ge $deadline ]; then
+                    echo "timed out waiting for {num_mons} mons (have $n)" >&2
+                    exit 1
+                fi
+                sleep $delay
+                [ $delay -lt 8 ] && delay=$((delay * 2))
+            done
+            """),
+    ])
+
+
 @contextlib.contextmanager
 def ceph_mons(ctx, config):
     """
@@ -867,56 +982,37 @@ def ceph_mons(ctx, config):
             # This is the old way of adding mons that works with the (early) octopus
             # cephadm scheduler.
             num_mons = 1
-            for remote, roles in ctx.cluster.remotes.items():
-                for mon in [r for r in roles
-                            if teuthology.is_type('mon', cluster_name)(r)]:
-                    c_, _, id_ = teuthology.split_role(mon)
-                    if c_ == cluster_name and id_ == ctx.ceph[cluster_name].first_mon:
-                        continue
-                    log.info('Adding %s on %s' % (mon, remote.shortname))
-                    num_mons += 1
-                    _shell(ctx, cluster_name, remote, [
-                        'ceph', 'orch', 'daemon', 'add', 'mon',
-                        remote.shortname + ':' + ctx.ceph[cluster_name].mons[mon] + '=' + id_,
-                    ])
-                    ctx.daemons.register_daemon(
-                        remote, 'mon', id_,
-                        cluster=cluster_name,
-                        fsid=fsid,
-                        logger=log.getChild(mon),
-                        wait=False,
-                        started=True,
-                    )
-                    daemons[mon] = (remote, id_)
-
-                    with contextutil.safe_while(sleep=1, tries=180) as proceed:
-                        while proceed():
-                            log.info('Waiting for %d mons in monmap...' % (num_mons))
-                            r = _shell(
-                                ctx=ctx,
-                                cluster_name=cluster_name,
-                                remote=remote,
-                                args=[
-                                    'ceph', 'mon', 'dump', '-f', 'json',
-                                ],
-                                stdout=StringIO(),
-                            )
-                            j = json.loads(r.stdout.getvalue())
-                            if len(j['mons']) == num_mons:
-                                break
+            for remote, mon in _roles_of_type(ctx, cluster_name, 'mon'):
+                c_, _, id_ = teuthology.split_role(mon)
+                if c_ == cluster_name and id_ == ctx.ceph[cluster_name].first_mon:
+                    continue
+                log.info('Adding %s on %s' % (mon, remote.shortname))
+                num_mons += 1
+                # add the mon and wait for it within a single shell
+                _wait_for_mons(ctx, cluster_name, remote, num_mons, first=[
+                    'ceph', 'orch', 'daemon', 'add', 'mon',
+                    remote.shortname + ':' + ctx.ceph[cluster_name].mons[mon] + '=' + id_,
+                ])
+                ctx.daemons.register_daemon(
+                    remote, 'mon', id_,
+                    cluster=cluster_name,
+                    fsid=fsid,
+                    logger=log.getChild(mon),
+                    wait=False,
+                    started=True,
+                )
+                daemons[mon] = (remote, id_)
         else:
             nodes = []
-            for remote, roles in ctx.cluster.remotes.items():
-                for mon in [r for r in roles
-                            if teuthology.is_type('mon', cluster_name)(r)]:
-                    c_, _, id_ = teuthology.split_role(mon)
-                    log.info('Adding %s on %s' % (mon, remote.shortname))
-                    nodes.append(remote.shortname
-                                 + ':' + ctx.ceph[cluster_name].mons[mon]
-                                 + '=' + id_)
-                    if c_ == cluster_name and id_ == ctx.ceph[cluster_name].first_mon:
-                        continue
-                    daemons[mon] = (remote, id_)
+            for remote, mon in _roles_of_type(ctx, cluster_name, 'mon'):
+                c_, _, id_ = teuthology.split_role(mon)
+                log.info('Adding %s on %s' % (mon, remote.shortname))
+                nodes.append(remote.shortname
+                             + ':' + ctx.ceph[cluster_name].mons[mon]
+                             + '=' + id_)
+                if c_ == cluster_name and id_ == ctx.ceph[cluster_name].first_mon:
+                    continue
+                daemons[mon] = (remote, id_)
 
             _shell(ctx, cluster_name, remote, [
                 'ceph', 'orch', 'apply', 'mon',
@@ -933,21 +1029,7 @@ def ceph_mons(ctx, config):
                     started=True,
                 )
 
-            with contextutil.safe_while(sleep=1, tries=180) as proceed:
-                while proceed():
-                    log.info('Waiting for %d mons in monmap...' % (len(nodes)))
-                    r = _shell(
-                        ctx=ctx,
-                        cluster_name=cluster_name,
-                        remote=remote,
-                        args=[
-                            'ceph', 'mon', 'dump', '-f', 'json',
-                        ],
-                        stdout=StringIO(),
-                    )
-                    j = json.loads(r.stdout.getvalue())
-                    if len(j['mons']) == len(nodes):
-                        break
+            _wait_for_mons(ctx, cluster_name, remote, len(nodes))
 
         # refresh our (final) ceph.conf file
         bootstrap_remote = ctx.ceph[cluster_name].bootstrap_remote
@@ -980,15 +1062,13 @@ def ceph_mgrs(ctx, config):
     try:
         nodes = []
         daemons = {}
-        for remote, roles in ctx.cluster.remotes.items():
-            for mgr in [r for r in roles
-                        if teuthology.is_type('mgr', cluster_name)(r)]:
-                c_, _, id_ = teuthology.split_role(mgr)
-                log.info('Adding %s on %s' % (mgr, remote.shortname))
-                nodes.append(remote.shortname + '=' + id_)
-                if c_ == cluster_name and id_ == ctx.ceph[cluster_name].first_mgr:
-                    continue
-                daemons[mgr] = (remote, id_)
+        for remote, mgr in _roles_of_type(ctx, cluster_name, 'mgr'):
+            c_, _, id_ = teuthology.split_role(mgr)
+            log.info('Adding %s on %s' % (mgr, remote.shortname))
+            nodes.append(remote.shortname + '=' + id_)
+            if c_ == cluster_name and id_ == ctx.ceph[cluster_name].first_mgr:
+                continue
+            daemons[mgr] = (remote, id_)
         if nodes:
             _shell(ctx, cluster_name, remote, [
                 'ceph', 'orch', 'apply', 'mgr',
@@ -1011,6 +1091,62 @@ def ceph_mgrs(ctx, config):
         pass
 
 
+def _zap_devs(ctx, cluster_name, remote, devs):
+    # zap all of the host's devices with one ceph-volume run, so we only
+    # pay for one container start
+    log.info('Zapping %s on %s...' % (' '.join(devs), remote.shortname))
+    _shell(ctx, cluster_name, remote, [
+        'ceph-volume', 'lvm', 'zap'] + devs)
+
+
+@contextlib.contextmanager
+def ceph_osds_zap(ctx, config):
+    """
+    Pick a device for each OSD and zap them in the background
+
+    Zapping does not depend on the mons, so it runs while they are
+    deployed.  distribute_config_and_admin_keyring waits for it before
+    rewriting the conf and keyring it uses, and ceph_osds checks its
+    result before creating any OSD.
+    """
+    cluster_name = config['cluster']
+
+    # provision OSDs in numeric order
+    id_to_remote = {}
+    devs_by_remote = {}
+    for remote in ctx.cluster.remotes.keys():
+        devs_by_remote[remote] = teuthology.get_scratch_devices(remote)
+    for remote, osd in _roles_of_type(ctx, cluster_name, 'osd'):
+        _, _, id_ = teuthology.split_role(osd)
+        id_to_remote[int(id_)] = (osd, remote)
+
+    # pick a device for each OSD
+    osd_devs = []
+    zap_devs_by_remote = {}
+    for osd_id in sorted(id_to_remote.keys()):
+        osd, remote = id_to_remote[osd_id]
+        devs = devs_by_remote[remote]
+        assert devs   ## FIXME ##
+        dev = devs.pop()
+        osd_devs.append((osd, remote, dev))
+        zap_devs_by_remote.setdefault(remote, []).append(dev)
+    ctx.ceph[cluster_name].devs_by_remote = devs_by_remote
+    ctx.ceph[cluster_name].osd_devs = osd_devs
+
+    def zap():
+        # zapping is local to each host, so do all hosts at once
+        with parallel() as p:
+            for remote, devs in zap_devs_by_remote.items():
+                p.spawn(_zap_devs, ctx, cluster_name, remote, devs)
+
+    ctx.ceph[cluster_name].osd_zap = gevent.spawn(zap)
+    try:
+        yield
+    finally:
+        # do not leave it running if we fail before ceph_osds
+        ctx.ceph[cluster_name].osd_zap.join()
+
+
 @contextlib.contextmanager
 def ceph_osds(ctx, config):
     """
@@ -1018,42 +1154,41 @@ def ceph_osds(ctx, config):
     """
     cluster_name = config['cluster']
     fsid = ctx.ceph[cluster_name].fsid
+    bootstrap_remote = ctx.ceph[cluster_name].bootstrap_remote
 
     try:
         log.info('Deploying OSDs...')
 
-        # provision OSDs in numeric order
-        id_to_remote = {}
-        devs_by_remote = {}
-        for remote, roles in ctx.cluster.remotes.items():
-            devs_by_remote[remote] = teuthology.get_scratch_devices(remote)
-            for osd in [r for r in roles
-                        if teuthology.is_type('osd', cluster_name)(r)]:
-                _, _, id_ = teuthology.split_role(osd)
-                id_to_remote[int(id_)] = (osd, remote)
+        devs_by_remote = ctx.ceph[cluster_name].devs_by_remote
+        osd_devs = ctx.ceph[cluster_name].osd_devs
+        log.info('Waiting for OSD devices to be zapped...')
+        ctx.ceph[cluster_name].osd_zap.get()
 
+        # create OSDs one at a time to keep their ids in order, but within
+        # a single shell so we only pay for one container start; bash -x
+        # logs each command as it runs
+        script = ''
         cur = 0
-        for osd_id in sorted(id_to_remote.keys()):
-            osd, remote = id_to_remote[osd_id]
+        for osd, remote, dev in osd_devs:
             _, _, id_ = teuthology.split_role(osd)
             assert int(id_) == cur
-            devs = devs_by_remote[remote]
-            assert devs   ## FIXME ##
-            dev = devs.pop()
             if all(_ in dev for _ in ('lv', 'vg')):
                 short_dev = dev.replace('/dev/', '')
             else:
                 short_dev = dev
-            log.info('Deploying %s on %s with %s...' % (
-                osd, remote.shortname, dev))
-            _shell(ctx, cluster_name, remote, [
-                'ceph-volume', 'lvm', 'zap', dev])
             add_osd_args = ['ceph', 'orch', 'daemon', 'add', 'osd',
                             remote.shortname + ':' + short_dev]
             osd_method = config.get('osd_method')
             if osd_method:
                 add_osd_args.append(osd_method)
-            _shell(ctx, cluster_name, remote, add_osd_args)
+            script += shlex.join(add_osd_args) + '\n'
+            cur += 1
+        if script:
+            log.info('Deploying %d OSDs...' % cur)
+            _shell(ctx, cluster_name, bootstrap_remote,
+                   ['bash', '-xec', script])
+        for osd, remote, dev in osd_devs:
+            _, _, id_ = teuthology.split_role(osd)
             ctx.daemons.register_daemon(
                 remote, 'osd', id_,
                 cluster=cluster_name,
@@ -1062,10 +1197,9 @@ def ceph_osds(ctx, config):
                 wait=False,
                 started=True,
             )
-            cur += 1
 
         if cur == 0:
-            _shell(ctx, cluster_name, remote, [
+            _shell(ctx, cluster_name, bootstrap_remote, [
                 'ceph', 'orch', 'apply', 'osd', '--all-available-devices',
             ])
             # expect the number of scratch devs
@@ -1078,7 +1212,7 @@ def ceph_osds(ctx, config):
         log.info(f'Waiting for {num_osds} OSDs to come up...')
         with contextutil.safe_while(sleep=1, tries=120) as proceed:
             while proceed():
-                p = _shell(ctx, cluster_name, ctx.ceph[cluster_name].bootstrap_remote,
+                p = _shell(ctx, cluster_name, bootstrap_remote,
                            ['ceph', 'osd', 'stat', '-f', 'json'], stdout=StringIO())
                 j = json.loads(p.stdout.getvalue())
                 if int(j.get('num_up_osds', 0)) == num_osds:
@@ -1109,13 +1243,11 @@ def ceph_mdss(ctx, config):
 
     nodes = []
     daemons = {}
-    for remote, roles in ctx.cluster.remotes.items():
-        for role in [r for r in roles
-                    if teuthology.is_type('mds', cluster_name)(r)]:
-            c_, _, id_ = teuthology.split_role(role)
-            log.info('Adding %s on %s' % (role, remote.shortname))
-            nodes.append(remote.shortname + '=' + id_)
-            daemons[role] = (remote, id_)
+    for remote, role in _roles_of_type(ctx, cluster_name, 'mds'):
+        c_, _, id_ = teuthology.split_role(role)
+        log.info('Adding %s on %s' % (role, remote.shortname))
+        nodes.append(remote.shortname + '=' + id_)
+        daemons[role] = (remote, id_)
     if nodes:
         _shell(ctx, cluster_name, remote, [
             'ceph', 'orch', 'apply', 'mds',
@@ -1186,13 +1318,11 @@ def ceph_monitoring(daemon_type, ctx, config):
 
     nodes = []
     daemons = {}
-    for remote, roles in ctx.cluster.remotes.items():
-        for role in [r for r in roles
-                    if teuthology.is_type(daemon_type, cluster_name)(r)]:
-            c_, _, id_ = teuthology.split_role(role)
-            log.info('Adding %s on %s' % (role, remote.shortname))
-            nodes.append(remote.shortname + '=' + id_)
-            daemons[role] = (remote, id_)
+    for remote, role in _roles_of_type(ctx, cluster_name, daemon_type):
+        c_, _, id_ = teuthology.split_role(role)
+        log.info('Adding %s on %s' % (role, remote.shortname))
+        nodes.append(remote.shortname + '=' + id_)
+        daemons[role] = (remote, id_)
     if nodes:
         _shell(ctx, cluster_name, remote, [
             'ceph', 'orch', 'apply', daemon_type,
@@ -1222,16 +1352,14 @@ def ceph_rgw(ctx, config):
 
     nodes = {}
     daemons = {}
-    for remote, roles in ctx.cluster.remotes.items():
-        for role in [r for r in roles
-                    if teuthology.is_type('rgw', cluster_name)(r)]:
-            c_, _, id_ = teuthology.split_role(role)
-            log.info('Adding %s on %s' % (role, remote.shortname))
-            svc = '.'.join(id_.split('.')[0:2])
-            if svc not in nodes:
-                nodes[svc] = []
-            nodes[svc].append(remote.shortname + '=' + id_)
-            daemons[role] = (remote, id_)
+    for remote, role in _roles_of_type(ctx, cluster_name, 'rgw'):
+        c_, _, id_ = teuthology.split_role(role)
+        log.info('Adding %s on %s' % (role, remote.shortname))
+        svc = '.'.join(id_.split('.')[0:2])
+        if svc not in nodes:
+            nodes[svc] = []
+        nodes[svc].append(remote.shortname + '=' + id_)
+        daemons[role] = (remote, id_)
 
     for svc, nodes in nodes.items():
         _shell(ctx, cluster_name, remote, [
@@ -1265,14 +1393,12 @@ def ceph_iscsi(ctx, config):
     daemons = {}
     ips = []
 
-    for remote, roles in ctx.cluster.remotes.items():
-        for role in [r for r in roles
-                     if teuthology.is_type('iscsi', cluster_name)(r)]:
-            c_, _, id_ = teuthology.split_role(role)
-            log.info('Adding %s on %s' % (role, remote.shortname))
-            nodes.append(remote.shortname + '=' + id_)
-            daemons[role] = (remote, id_)
-            ips.append(remote.ip_address)
+    for remote, role in _roles_of_type(ctx, cluster_name, 'iscsi'):
+        c_, _, id_ = teuthology.split_role(role)
+        log.info('Adding %s on %s' % (role, remote.shortname))
+        nodes.append(remote.shortname + '=' + id_)
+        daemons[role] = (remote, id_)
+        ips.append(remote.ip_address)
     trusted_ip_list = ','.join(ips)
     if nodes:
         poolname = 'datapool'
@@ -1599,23 +1725,29 @@ def distribute_config_and_admin_keyring(ctx, config):
     Distribute a sufficient config and keyring for clients
     """
     cluster_name = config['cluster']
+    # the OSD devices may still be being zapped in the background, with
+    # these files bind-mounted into the cephadm shell; let that finish
+    # before we rewrite them
+    osd_zap = getattr(ctx.ceph[cluster_name], 'osd_zap', None)
+    if osd_zap is not None:
+        log.info('Waiting for OSD devices to be zapped...')
+        osd_zap.join()
     log.info('Distributing (final) config and client.admin keyring...')
+    paths = ctx.ceph[cluster_name].paths
     for remote, roles in ctx.cluster.remotes.items():
         remote.write_file(
-            '/etc/ceph/{}.conf'.format(cluster_name),
+            paths.conf,
             ctx.ceph[cluster_name].config_file,
             sudo=True)
         remote.write_file(
-            path='/etc/ceph/{}.client.admin.keyring'.format(cluster_name),
+            path=paths.admin_keyring,
             data=ctx.ceph[cluster_name].admin_keyring,
             sudo=True)
     try:
         yield
     finally:
         ctx.cluster.run(args=[
-            'sudo', 'rm', '-f',
-            '/etc/ceph/{}.conf'.format(cluster_name),
-            '/etc/ceph/{}.client.admin.keyring'.format(cluster_name),
+            'sudo', 'rm', '-f', paths.conf, paths.admin_keyring,
         ])
 
 
@@ -1694,8 +1826,12 @@ def initialize_config(ctx, config):
     # mon ips
     log.info('Choosing monitor IPs and ports...')
     remotes_and_roles = ctx.cluster.remotes.items()
-    ips = [host for (host, port) in
-           (remote.ssh.get_transport().getpeername() for (remote, role_list) in remotes_and_roles)]
+    # note: roles holds the hosts' role lists themselves, so it also sees
+    # any mons fabricated below
+    roles, ips = [], []
+    for remote, role_list in remotes_and_roles:
+        roles.append(role_list)
+        ips.append(remote.ssh.get_transport().getpeername()[0])
 
     if config.get('roleless', False):
         # mons will be named after hosts
@@ -1711,7 +1847,8 @@ def initialize_config(ctx, config):
                 break
         log.info('No mon roles; fabricating mons')
 
-    roles = [role_list for (remote, role_list) in ctx.cluster.remotes.items()]
+    # roles are (re)classified by _roles_of_type() on first use
+    ctx.ceph[cluster_name].roles_by_type = None
 
     ctx.ceph[cluster_name].mons = get_mons(
         roles, ips, cluster_name,
@@ -1726,7 +1863,7 @@ def initialize_config(ctx, config):
         ctx.ceph[cluster_name].first_mon = first_mon
         ctx.ceph[cluster_name].first_mon_role = 'mon.' + first_mon
     else:
-        first_mon_role = sorted(ctx.ceph[cluster_name].mons.keys())[0]
+        first_mon_role = min(ctx.ceph[cluster_name].mons)
         _, _, first_mon = teuthology.split_role(first_mon_role)
         (bootstrap_remote,) = ctx.cluster.only(first_mon_role).remotes.keys()
         log.info('First mon is mon.%s on %s' % (first_mon,
@@ -1736,11 +1873,12 @@ def initialize_config(ctx, config):
         ctx.ceph[cluster_name].first_mon_role = first_mon_role
 
         others = ctx.cluster.remotes[bootstrap_remote]
-        mgrs = sorted([r for r in others
-                       if teuthology.is_type('mgr', cluster_name)(r)])
-        if not mgrs:
+        first_mgr_role = min((r for r in others
+                              if teuthology.is_type('mgr', cluster_name)(r)),
+                             default=None)
+        if first_mgr_role is None:
             raise RuntimeError('no mgrs on the same host as first mon %s' % first_mon)
-        _, _, first_mgr = teuthology.split_role(mgrs[0])
+        _, _, first_mgr = teuthology.split_role(first_mgr_role)
         log.info('First mgr is %s' % (first_mgr))
         ctx.ceph[cluster_name].first_mgr = first_mgr
     yield
@@ -1794,6 +1932,15 @@ def task(ctx, config):
         ctx.ceph[cluster_name] = argparse.Namespace()
         ctx.ceph[cluster_name].bootstrapped = False
 
+    # well-known paths
+    testdir = teuthology.get_testdir(ctx)
+    ctx.ceph[cluster_name].paths = argparse.Namespace(
+        conf='/etc/ceph/{}.conf'.format(cluster_name),
+        admin_keyring='/etc/ceph/{}.client.admin.keyring'.format(cluster_name),
+        seed_conf='{}/seed.{}.conf'.format(testdir, cluster_name),
+        pub_ssh_key='{}/{}.pub'.format(testdir, cluster_name),
+    )
+
     # image
     teuth_defaults = teuth_config.get('defaults', {})
     cephadm_defaults = teuth_defaults.get('cephadm', {})
@@ -1844,6 +1991,7 @@ def task(ctx, config):
             lambda: _bypass() if (ctx.ceph[cluster_name].bootstrapped) \
                               else ceph_bootstrap(ctx, config),
             lambda: crush_setup(ctx=ctx, config=config),
+            lambda: ceph_osds_zap(ctx=ctx, config=config),
             lambda: ceph_mons(ctx=ctx, config=config),
             lambda: distribute_config_and_admin_keyring(ctx=ctx, config=config),
             lambda: ceph_mgrs(ctx=ctx, config=config),